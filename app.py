@@ -1,4 +1,11 @@
+import atexit
+from concurrent.futures import ThreadPoolExecutor, wait
+import functools
+import hashlib
+from html import escape, unescape
 import os
+import re
+import time
 
 import bleach
 from bs4 import BeautifulSoup
@@ -6,8 +13,13 @@ from flask import Flask, jsonify, request, abort, g
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 from flask_socketio import SocketIO
-from markdown import markdown
+import lxml.etree
+import lxml.html
+import markdown
+import redis
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import threading
 
 import config
@@ -27,6 +39,241 @@ if message_queue:
     socketio = SocketIO(message_queue=message_queue)
 else:
     socketio = None
+if message_queue:
+    cache = redis.StrictRedis.from_url(message_queue, decode_responses=True)
+else:
+    cache = None
+
+render_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('RENDER_WORKERS', '8')))
+atexit.register(render_pool.shutdown, wait=True)
+link_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('LINK_WORKERS', '16')))
+atexit.register(link_pool.shutdown, wait=True)
+pending_renders = {}  # message id -> True if the message needs a new render
+pending_renders_lock = threading.Lock()
+emit_state = threading.local()
+
+http_session = requests.Session()
+http_session.max_redirects = 3
+for prefix in ['http://', 'https://']:
+    http_session.mount(prefix, HTTPAdapter(
+        pool_connections=32, pool_maxsize=64,
+        max_retries=Retry(total=1, backoff_factor=0.2)))
+LINK_TIMEOUT = (3, 5)  # connect and read timeouts, in seconds
+LINK_HEAD_MAX_SIZE = 64 * 1024
+LINK_HEAD_DEADLINE = 10  # max seconds to spend downloading a page head
+LINK_EXPAND_TIMEOUT = 15  # max seconds to wait for all the link previews
+LINK_CACHE_MAX_AGE = 60 * 60
+LINK_CACHE_TTL = 24 * 60 * 60
+# the page is untrusted input, so these patterns are bounded to keep their
+# matching time linear on the size of the page
+TITLE_RE = re.compile(rb'<title[^>]{0,256}>([^<]{0,1024})</title>', re.I)
+META_RE = re.compile(rb'<meta\s[^>]{0,1024}>', re.I)
+META_ATTR_RE = re.compile(
+    rb'(?<![\w-])([\w-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))')
+CHARSET_RE = re.compile(rb'charset=["\']?([\w-]+)', re.I)
+
+MESSAGE_URL = '/api/messages/{}'
+USER_URL = '/users/{}'
+
+ALLOWED_TAGS = ('a', 'abbr', 'acronym', 'b', 'code', 'em', 'i', 'strong')
+RENDER_CACHE_TTL = 24 * 60 * 60
+# characters and sequences that may be interpreted as markdown, inline HTML,
+# entities or links; messages without any of these render as plain text
+MARKUP_RE = re.compile(r'[\\`*_\[\]#<>&]|[^\S ]|^[\s+=-]|\s$|\d\.|\.\w|://')
+renderers = threading.local()  # per-thread markdown and bleach instances
+
+
+@functools.lru_cache(maxsize=4096)
+def render_html(source):
+    """Render markdown source to sanitized HTML.
+
+    Results are cached in memory, and also in Redis when available so that
+    they are shared among all the workers.
+    """
+    key = None
+    if cache:
+        digest = hashlib.sha1(
+            repr((source, ALLOWED_TAGS)).encode('utf-8')).hexdigest()
+        key = 'rendered:' + digest
+        html = cache.get(key)
+        if html is not None:
+            return html
+    if not hasattr(renderers, 'markdown'):
+        renderers.markdown = markdown.Markdown(output_format='html')
+        renderers.cleaner = bleach.sanitizer.Cleaner(tags=ALLOWED_TAGS,
+                                                     strip=True)
+        renderers.linker = bleach.linkifier.Linker()
+    html = renderers.linker.linkify(renderers.cleaner.clean(
+        renderers.markdown.reset().convert(source)))
+    if key:
+        cache.set(key, html, ex=RENDER_CACHE_TTL)
+    return html
+
+
+def find_meta_description(head):
+    """Return the description and charset given in the meta tags of a page.
+
+    Each meta tag is matched on its own and then split into attributes, as
+    a single pattern for the whole tag can backtrack excessively.
+    """
+    description = charset = None
+    for tag in META_RE.finditer(head):
+        attrs = {}
+        for name, dq_value, sq_value, value in META_ATTR_RE.findall(
+                tag.group()):
+            attrs.setdefault(name.lower(), dq_value or sq_value or value)
+        if description is None and \
+                attrs.get(b'name', b'').lower() == b'description':
+            description = attrs.get(b'content')
+        if charset is None:
+            if b'charset' in attrs:
+                charset = attrs[b'charset']
+            elif attrs.get(b'http-equiv', b'').lower() == b'content-type':
+                match = CHARSET_RE.search(attrs.get(b'content', b''))
+                if match:
+                    charset = match.group(1)
+        if description is not None and charset is not None:
+            break
+    if charset is not None:
+        charset = charset.decode('ascii', 'replace')
+    return description, charset
+
+
+def parse_link_preview(url, rv):
+    """Extract the title and description of a linked page."""
+    content_type = rv.headers.get('content-type')
+    if content_type and 'text/html' not in content_type:
+        return None
+    encoding = None
+    if content_type and 'charset=' in content_type.lower():
+        encoding = rv.encoding
+    try:
+        # the title and description are in the <head> section of the page,
+        # so there is no need to download the rest; the read timeout applies
+        # to each individual read, so an overall deadline is also enforced
+        # to stop servers that send data very slowly
+        deadline = time.monotonic() + LINK_HEAD_DEADLINE
+        head = b''
+        for chunk in rv.iter_content(chunk_size=4096):
+            if time.monotonic() > deadline:
+                return None
+            head += chunk
+            if b'</head>' in head.lower() or \
+                    len(head) >= LINK_HEAD_MAX_SIZE:
+                break
+    except requests.exceptions.RequestException:
+        return None
+
+    # in the common case both items can be found without parsing the page
+    title = TITLE_RE.search(head)
+    if title:
+        description, charset = find_meta_description(head)
+        if description is not None:
+            charset = encoding or charset or 'utf-8'
+            try:
+                title = title.group(1).decode(charset, 'replace')
+                description = description.decode(charset, 'replace')
+            except LookupError:
+                pass  # unknown charset, let lxml figure it out
+            else:
+                return (unescape(title).strip() or url,
+                        unescape(description).strip())
+
+    try:
+        parser = None
+        if encoding:
+            parser = lxml.html.HTMLParser(encoding=encoding)
+        doc = lxml.html.fromstring(head, parser=parser)
+    except (LookupError, lxml.etree.LxmlError):
+        return None
+    title = doc.xpath('string(//title)').strip() or url
+    description = doc.xpath(
+        '//meta[translate(@name, "DESCRIPTION", "description")='
+        '"description"]/@content')
+    if description:
+        description = description[0].strip()
+    else:
+        description = 'No description found.'
+    return title, description
+
+
+def get_link_preview(url):
+    """Return the title and description of a linked page.
+
+    When Redis is available previews are cached, and once they become stale
+    they are revalidated with a conditional request.
+    """
+    key = 'linkprev:' + url
+    cached = {}
+    if cache:
+        try:
+            cached = cache.hgetall(key)
+        except redis.RedisError:
+            # the cache is only an optimization, so carry on without it
+            app.logger.warning('Could not read link preview for %s from the '
+                               'cache', url, exc_info=True)
+    if 'title' not in cached:
+        cached = {}  # missing or incomplete entry
+    now = timestamp()
+    if cached and \
+            now - int(cached.get('fetched_at', 0)) < LINK_CACHE_MAX_AGE:
+        return cached['title'], cached['description']
+    headers = {}
+    if cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+    try:
+        rv = http_session.get(url, headers=headers, timeout=LINK_TIMEOUT,
+                              stream=True)
+    except requests.exceptions.RequestException:
+        return None
+    try:
+        if rv.status_code == 304 and cached:
+            preview = (cached['title'], cached['description'])
+            # the entry could have expired since it was read, so it is
+            # written back in full
+            cached['fetched_at'] = now
+        elif rv.status_code == 200:
+            preview = parse_link_preview(url, rv)
+            if preview is None:
+                return None
+            cached = {'title': preview[0], 'description': preview[1],
+                      'etag': rv.headers.get('etag', ''),
+                      'last_modified': rv.headers.get('last-modified', ''),
+                      'fetched_at': now}
+        else:
+            return None
+    finally:
+        rv.close()
+    if cache:
+        try:
+            pipe = cache.pipeline()
+            pipe.hmset(key, cached)
+            pipe.expire(key, LINK_CACHE_TTL)
+            pipe.execute()
+        except redis.RedisError:
+            app.logger.warning('Could not write link preview for %s to the '
+                               'cache', url, exc_info=True)
+    return preview
+
+
+def message_to_dict(id, created_at, updated_at, source, html, user_id):
+    """Export message fields to a dictionary."""
+    return {
+        'id': id,
+        'created_at': created_at,
+        'updated_at': updated_at,
+        'source': source,
+        'html': html,
+        'user_id': user_id,
+        '_links': {
+            'self': MESSAGE_URL.format(id),
+            'user': USER_URL.format(user_id)
+        }
+    }
 
 
 class Message(db.Model):
@@ -34,7 +281,8 @@ class Message(db.Model):
     __tablename__ = 'messages'
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.Integer, default=timestamp)
-    updated_at = db.Column(db.Integer, default=timestamp, onupdate=timestamp)
+    updated_at = db.Column(db.Integer, default=timestamp, onupdate=timestamp,
+                           index=True)
     source = db.Column(db.Text, nullable=False)
     html = db.Column(db.Text, nullable=False)
     user_id = db.Column(db.Integer, nullable=False)
@@ -50,75 +298,123 @@ class Message(db.Model):
 
     def to_dict(self):
         """Export message to a dictionary."""
-        return {
-            'id': self.id,
-            'created_at': self.created_at,
-            'updated_at': self.updated_at,
-            'source': self.source,
-            'html': self.html,
-            'user_id': self.user_id,
-            '_links': {
-                'self': url_for('get_message', id=self.id),
-                'user': '/users/{}'.format(self.user_id)
-            }
-        }
+        return message_to_dict(self.id, self.created_at, self.updated_at,
+                               self.source, self.html, self.user_id)
 
     def render_markdown(self):
         """Render markdown source to HTML with a tag whitelist."""
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i',
-                        'strong']
-        self.html = bleach.linkify(bleach.clean(
-            markdown(self.source, output_format='html'),
-            tags=allowed_tags, strip=True))
+        if not MARKUP_RE.search(self.source):
+            self.html = escape(self.source, quote=False)
+            return
+        self.html = render_html(self.source)
 
     def expand_links(self):
         """Expand any links referenced in the message."""
         if '<blockquote>' in self.html:
             # links have been already expanded
             return False
-        changed = False
-        for link in BeautifulSoup(self.html, 'html5lib').select('a'):
-            url = link.get('href', '')
+        urls = [link.get('href', '')
+                for link in BeautifulSoup(self.html, 'lxml').select('a')]
+        futures = [link_pool.submit(get_link_preview, url) for url in urls]
+        # a blocked read can outlast the deadline in parse_link_preview, so
+        # links that are not ready in time are left without a preview
+        done, not_done = wait(futures, timeout=LINK_EXPAND_TIMEOUT)
+        parts = [self.html]
+        for url, future in zip(urls, futures):
+            if future in not_done:
+                future.cancel()  # only stops it if it has not started yet
+                app.logger.warning('Timed out expanding link %s', url)
+                continue
+            # a failure with a link should not affect the others
             try:
-                rv = requests.get(url)
-            except requests.exceptions.ConnectionError:
+                preview = future.result()
+            except Exception:
+                app.logger.exception('Could not expand link %s', url)
+                continue
+            if preview is None:
                 continue
-            if rv.status_code == 200:
-                soup = BeautifulSoup(rv.text, 'html5lib')
-                title_tags = soup.select('title')
-                if len(title_tags) > 0:
-                    title = title_tags[0].string.strip()
-                else:
-                    title = url
-                description = 'No description found.'
-                for meta in soup.select('meta'):
-                    if meta.get('name', '').lower() == 'description':
-                        description = meta.get('content', description).strip()
-                        break
-                # add the detail of the link to the rendered message
-                tpl = ('<blockquote><p><a href="{url}">{title}</a></p>'
-                       '<p>{desc}</p></blockquote>')
-                self.html += tpl.format(url=url, title=title, desc=description)
-                changed = True
-        return changed
+            title, description = preview
+            # add the detail of the link to the rendered message
+            tpl = ('<blockquote><p><a href="{url}">{title}</a></p>'
+                   '<p>{desc}</p></blockquote>')
+            parts.append(tpl.format(url=url, title=title, desc=description))
+        if len(parts) == 1:
+            return False
+        self.html = ''.join(parts)
+        return True
 
 
-@db.event.listens_for(Message, 'after_update')
-def after_user_update(mapper, connection, target):
+def emit_update(target):
     if socketio:
         socketio.emit('updated_model', {'class': target.__class__.__name__,
                                         'model': target.to_dict()})
 
 
+@db.event.listens_for(Message, 'after_update')
+def after_user_update(mapper, connection, target):
+    if not getattr(emit_state, 'suppressed', False):
+        emit_update(target)
+
+
 def render_message(id):
+    """Render a message, coalescing concurrent requests for the same id."""
+    with pending_renders_lock:
+        if id in pending_renders:
+            # a render for this message is in progress, ask it to run again
+            # once it is done so that it picks up the latest source
+            pending_renders[id] = True
+            return
+        pending_renders[id] = False
+    again = True
+    error = None
+    while again:
+        try:
+            _render_message(id)
+        except Exception as exc:
+            # a render requested while this one was running must still
+            # happen, so the error is raised only after that
+            error = error or exc
+        with pending_renders_lock:
+            again = pending_renders[id]
+            if again:
+                pending_renders[id] = False
+            else:
+                del pending_renders[id]
+    if error is not None:
+        raise error
+
+
+def log_render_error(future):
+    """Log the error raised by a background render, if any."""
+    if future.cancelled() or future.exception() is None:
+        return
+    exc = future.exception()
+    app.logger.error('Message render failed',
+                     exc_info=(type(exc), exc, exc.__traceback__))
+
+
+def _render_message(id):
     with app.app_context():
         msg = Message.query.get(id)
         if not msg:
             return
-        msg.render_markdown()
-        db.session.commit()  # first update with rendered markdown
-        if (msg.expand_links()):
-            db.session.commit()  # final update with expanded links
+        # the updates made while rendering are sent to clients only once,
+        # with the final state of the message
+        emit_state.suppressed = True
+        try:
+            msg.render_markdown()
+            if '<a ' in msg.html:
+                # expanding the links can take a while, so the rendered
+                # markdown is saved first
+                db.session.commit()
+            try:
+                msg.expand_links()
+            except Exception:
+                app.logger.exception('Link expansion failed')
+            db.session.commit()
+        finally:
+            emit_state.suppressed = False
+        emit_update(msg)
 
 
 @app.route('/api/messages', methods=['POST'])
@@ -143,9 +439,8 @@ def new_message():
         render_message(msg.id)
     else:
         # asynchronous rendering
-        render_thread = threading.Thread(target=render_message,
-                                         args=(msg.id,))
-        render_thread.start()
+        render_pool.submit(render_message, msg.id).add_done_callback(
+            log_render_error)
     return r
 
 
@@ -162,9 +457,14 @@ def get_messages():
     if since < day_ago:
         # do not return more than a day worth of messages
         since = day_ago
-    msgs = Message.query.filter(Message.updated_at >= since).order_by(
-        Message.updated_at)
-    return jsonify({'messages': [msg.to_dict() for msg in msgs.all()]})
+    # query the columns directly, as there is no need for model instances,
+    # and fetch the rows from the database cursor in batches
+    rows = db.session.query(
+        Message.id, Message.created_at, Message.updated_at, Message.source,
+        Message.html, Message.user_id).filter(
+            Message.updated_at >= since).order_by(
+                Message.updated_at).yield_per(200)
+    return jsonify({'messages': [message_to_dict(*row) for row in rows]})
 
 
 @app.route('/api/messages/<id>', methods=['GET'])
@@ -199,9 +499,8 @@ def edit_message(id):
         render_message(msg.id)
     else:
         # asynchronous rendering
-        render_thread = threading.Thread(target=render_message,
-                                         args=(msg.id,))
-        render_thread.start()
+        render_pool.submit(render_message, msg.id).add_done_callback(
+            log_render_error)
     return '', 204
 
 
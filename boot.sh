@@ -8,5 +8,7 @@ if [ "$SERVICE_URL" != "" ]; then
     python -c "from microflack_common.container import register; register()" &
 fi
 
-# run web server
-exec gunicorn -b 0.0.0.0:5000 --access-logfile - --error-logfile - app:app
+# run web server, with threaded workers so that requests blocked on I/O do
+# not hold up the whole worker process
+exec gunicorn -b 0.0.0.0:5000 -k gthread --threads ${GUNICORN_THREADS:-8} \
+    --access-logfile - --error-logfile - app:app
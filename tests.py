@@ -2,10 +2,13 @@
 import os
 os.environ['FLASK_CONFIG'] = 'test'
 
+import hashlib
 import mock
+import threading
 import time
 import unittest
 
+import redis
 import requests
 
 from microflack_common.auth import generate_token
@@ -13,7 +16,8 @@ from microflack_common.test import FlackTestCase
 
 import app
 app.socketio = mock.MagicMock()
-from app import app, db, socketio
+from app import app, db, socketio, pending_renders, render_message, \
+    parse_link_preview, render_html, ALLOWED_TAGS, RENDER_CACHE_TTL
 
 
 class MessageTests(FlackTestCase):
@@ -99,10 +103,20 @@ class MessageTests(FlackTestCase):
                            token_auth=token2)
         self.assertEqual(s, 403)
 
+        # create a plain text message
+        r, s, h = self.post('/api/messages',
+                            data={'source': "it's 5 o'clock"},
+                            token_auth=token)
+        self.assertEqual(s, 201)
+        r, s, h = self.get(h['Location'], token_auth=token)
+        self.assertEqual(s, 200)
+        self.assertEqual(r['html'], "it's 5 o'clock")
+
         def responses():
             rv = requests.Response()
             rv.status_code = 200
             rv.encoding = 'utf-8'
+            rv._content_consumed = True
             rv._content = (b'<html><head><title>foo</title>'
                            b'<meta name="blah" content="blah">'
                            b'<meta name="description" content="foo descr">'
@@ -111,18 +125,20 @@ class MessageTests(FlackTestCase):
             rv = requests.Response()
             rv.status_code = 200
             rv.encoding = 'utf-8'
+            rv._content_consumed = True
             rv._content = b'<html><head><title>bar</title></head></html>'
             yield rv
             rv = requests.Response()
             rv.status_code = 200
             rv.encoding = 'utf-8'
+            rv._content_consumed = True
             rv._content = (b'<html><head>'
                            b'<meta name="description" content="baz descr">'
                            b'</head></html>')
             yield rv
             yield requests.exceptions.ConnectionError()
 
-        with mock.patch('app.requests.get', side_effect=responses()):
+        with mock.patch('app.http_session.get', side_effect=responses()):
             r, s, h = self.post(
                 '/api/messages',
                 data={'source': 'hello http://foo.com!'},
@@ -178,6 +194,252 @@ class MessageTests(FlackTestCase):
                 'hello <a href="http://foo.com" rel="nofollow">'
                 'foo.com</a>!')
 
+        # rendering a message with links emits a single update
+        rv = requests.Response()
+        rv.status_code = 200
+        rv.encoding = 'utf-8'
+        rv._content = (b'<html><head><title>qux</title>'
+                       b'<meta name="description" content="qux descr">'
+                       b'</head></html>')
+        rv._content_consumed = True
+        with mock.patch('app.http_session.get', return_value=rv):
+            emit_count = socketio.emit.call_count
+            r, s, h = self.post('/api/messages',
+                                data={'source': 'hello http://qux.com!'},
+                                token_auth=token)
+            self.assertEqual(s, 201)
+            self.assertEqual(socketio.emit.call_count, emit_count + 1)
+            self.assertEqual(
+                socketio.emit.call_args[0][1]['model']['html'],
+                'hello <a href="http://qux.com" rel="nofollow">'
+                'http://qux.com</a>!<blockquote><p><a href="http://qux.com">'
+                'qux</a></p><p>qux descr</p></blockquote>')
+
+        bar_html = ('hello <a href="http://bar.com" rel="nofollow">'
+                    'http://bar.com</a>!<blockquote><p>'
+                    '<a href="http://bar.com">bar</a></p><p>bar descr</p>'
+                    '</blockquote>')
+        with mock.patch('app.cache') as cache, \
+                mock.patch('app.http_session.get') as http_get:
+            cache.get.return_value = None
+            pipe = cache.pipeline.return_value
+
+            # fresh link preview in the cache
+            cached = {'title': 'bar', 'description': 'bar descr',
+                      'etag': '"abc"',
+                      'last_modified': 'Wed, 21 Oct 2015 07:28:00 GMT',
+                      'fetched_at': str(int(time.time()))}
+            cache.hgetall.return_value = cached
+            r, s, h = self.post('/api/messages',
+                                data={'source': 'hello http://bar.com!'},
+                                token_auth=token)
+            self.assertEqual(s, 201)
+            r, s, h = self.get(h['Location'], token_auth=token)
+            self.assertEqual(s, 200)
+            self.assertEqual(r['html'], bar_html)
+            self.assertFalse(http_get.called)
+            self.assertFalse(pipe.hmset.called)
+
+            # stale link preview in the cache, revalidated by the server
+            cached['fetched_at'] = str(int(time.time()) - 2 * 60 * 60)
+            cache.hgetall.return_value = dict(cached)
+            rv = requests.Response()
+            rv.status_code = 304
+            rv._content = b''
+            rv._content_consumed = True
+            http_get.return_value = rv
+            r, s, h = self.post('/api/messages',
+                                data={'source': 'hello http://bar.com!'},
+                                token_auth=token)
+            self.assertEqual(s, 201)
+            r, s, h = self.get(h['Location'], token_auth=token)
+            self.assertEqual(s, 200)
+            self.assertEqual(r['html'], bar_html)
+            self.assertEqual(http_get.call_args[1]['headers'], {
+                'If-None-Match': '"abc"',
+                'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+            self.assertEqual(pipe.hmset.call_args[0][0],
+                             'linkprev:http://bar.com')
+            written = pipe.hmset.call_args[0][1]
+            self.assertEqual(written['title'], 'bar')
+            self.assertEqual(written['description'], 'bar descr')
+            self.assertEqual(written['etag'], '"abc"')
+            self.assertEqual(written['last_modified'],
+                             'Wed, 21 Oct 2015 07:28:00 GMT')
+            self.assertGreater(written['fetched_at'], int(time.time()) - 60)
+
+            # incomplete link preview in the cache is ignored
+            cache.hgetall.return_value = {'fetched_at': str(int(time.time()))}
+            rv = requests.Response()
+            rv.status_code = 200
+            rv.encoding = 'utf-8'
+            rv._content = (b'<html><head><title>bar</title>'
+                           b'<meta name="description" content="bar descr">'
+                           b'</head></html>')
+            rv._content_consumed = True
+            http_get.return_value = rv
+            r, s, h = self.post('/api/messages',
+                                data={'source': 'hello http://bar.com!'},
+                                token_auth=token)
+            self.assertEqual(s, 201)
+            r, s, h = self.get(h['Location'], token_auth=token)
+            self.assertEqual(s, 200)
+            self.assertEqual(r['html'], bar_html)
+            self.assertEqual(http_get.call_args[1]['headers'], {})
+            self.assertEqual(pipe.hmset.call_args[0][1]['title'], 'bar')
+
+            # a cache failure falls back to fetching the page
+            cache.hgetall.side_effect = redis.RedisError()
+            pipe.execute.side_effect = redis.RedisError()
+            http_get.reset_mock()
+            r, s, h = self.post('/api/messages',
+                                data={'source': 'hello http://bar.com!'},
+                                token_auth=token)
+            self.assertEqual(s, 201)
+            r, s, h = self.get(h['Location'], token_auth=token)
+            self.assertEqual(s, 200)
+            self.assertEqual(r['html'], bar_html)
+            self.assertTrue(http_get.called)
+
+        # a failure expanding links does not prevent the message from
+        # being rendered, and still emits a single update
+        with mock.patch('app.Message.expand_links',
+                        side_effect=RuntimeError()):
+            emit_count = socketio.emit.call_count
+            r, s, h = self.post('/api/messages',
+                                data={'source': 'hello http://baz.com!'},
+                                token_auth=token)
+            self.assertEqual(s, 201)
+            self.assertEqual(socketio.emit.call_count, emit_count + 1)
+            self.assertEqual(
+                socketio.emit.call_args[0][1]['model']['html'],
+                'hello <a href="http://baz.com" rel="nofollow">'
+                'http://baz.com</a>!')
+            r, s, h = self.get(h['Location'], token_auth=token)
+            self.assertEqual(s, 200)
+            self.assertEqual(
+                r['html'],
+                'hello <a href="http://baz.com" rel="nofollow">'
+                'http://baz.com</a>!')
+
+        # a failure expanding a link does not affect the other links
+        def preview(url):
+            if url == 'http://baz.com':
+                raise RuntimeError()
+            return 'bar', 'bar descr'
+
+        with mock.patch('app.get_link_preview', side_effect=preview):
+            r, s, h = self.post(
+                '/api/messages',
+                data={'source': 'http://baz.com http://bar.com'},
+                token_auth=token)
+            self.assertEqual(s, 201)
+            r, s, h = self.get(h['Location'], token_auth=token)
+            self.assertEqual(s, 200)
+            self.assertEqual(
+                r['html'],
+                '<a href="http://baz.com" rel="nofollow">http://baz.com</a> '
+                '<a href="http://bar.com" rel="nofollow">http://bar.com</a>'
+                '<blockquote><p><a href="http://bar.com">bar</a></p>'
+                '<p>bar descr</p></blockquote>')
+
+        # links that take too long to expand are left without a preview
+        release = threading.Event()
+
+        def slow_preview(url):
+            if url == 'http://baz.com':
+                release.wait(5)
+            return url[7:10], url[7:10] + ' descr'
+
+        with mock.patch('app.get_link_preview', side_effect=slow_preview), \
+                mock.patch('app.LINK_EXPAND_TIMEOUT', 0.1):
+            r, s, h = self.post(
+                '/api/messages',
+                data={'source': 'http://baz.com http://bar.com'},
+                token_auth=token)
+            release.set()
+            self.assertEqual(s, 201)
+            r, s, h = self.get(h['Location'], token_auth=token)
+            self.assertEqual(s, 200)
+            self.assertEqual(
+                r['html'],
+                '<a href="http://baz.com" rel="nofollow">http://baz.com</a> '
+                '<a href="http://bar.com" rel="nofollow">http://bar.com</a>'
+                '<blockquote><p><a href="http://bar.com">bar</a></p>'
+                '<p>bar descr</p></blockquote>')
+
+    def test_render_cache(self):
+        source = 'some *text*'
+        key = 'rendered:' + hashlib.sha1(
+            repr((source, ALLOWED_TAGS)).encode('utf-8')).hexdigest()
+        with mock.patch('app.cache') as cache:
+            # rendered HTML found in redis is used without rendering
+            render_html.cache_clear()
+            cache.get.return_value = 'cached <em>html</em>'
+            self.assertEqual(render_html(source), 'cached <em>html</em>')
+            cache.get.assert_called_once_with(key)
+            self.assertFalse(cache.set.called)
+
+            # rendered HTML is stored in redis on a miss
+            render_html.cache_clear()
+            cache.get.return_value = None
+            self.assertEqual(render_html(source), 'some <em>text</em>')
+            cache.set.assert_called_once_with(key, 'some <em>text</em>',
+                                              ex=RENDER_CACHE_TTL)
+        render_html.cache_clear()
+
+    def test_render_coalescing(self):
+        with mock.patch('app._render_message') as render:
+            # a render in progress absorbs new render requests
+            pending_renders[1] = False
+            render_message(1)
+            self.assertFalse(render.called)
+            self.assertTrue(pending_renders.pop(1))
+
+            # a render requested during a render causes one more render
+            def edit_during_render(id):
+                if render.call_count == 1:
+                    render_message(id)
+
+            render.side_effect = edit_during_render
+            render_message(1)
+            self.assertEqual(render.call_count, 2)
+            self.assertNotIn(1, pending_renders)
+
+            # a failed render does not leave the message as pending
+            render.reset_mock()
+            render.side_effect = RuntimeError()
+            with self.assertRaises(RuntimeError):
+                render_message(1)
+            self.assertEqual(render.call_count, 1)
+            self.assertNotIn(1, pending_renders)
+
+            # a render requested during a failed render still happens
+            def edit_during_failed_render(id):
+                if render.call_count == 1:
+                    render_message(id)
+                    raise RuntimeError()
+
+            render.reset_mock()
+            render.side_effect = edit_during_failed_render
+            with self.assertRaises(RuntimeError):
+                render_message(1)
+            self.assertEqual(render.call_count, 2)
+            self.assertNotIn(1, pending_renders)
+
+    def test_link_preview_pathological_head(self):
+        # a head that makes backtracking patterns take a very long time
+        rv = requests.Response()
+        rv.status_code = 200
+        rv.encoding = 'utf-8'
+        metas = b'<meta name=description ' * 2900
+        rv._content = b'<html><head><title>foo</title>' + metas
+        rv._content_consumed = True
+        start = time.time()
+        preview = parse_link_preview('http://foo.com', rv)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(preview[0], 'foo')
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)